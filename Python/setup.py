@@ -19,5 +19,6 @@ setup(
     url='https://github.com/ccourson/xArmServoController/tree/master/PC/Python/xarm',
     license=license,
     packages=find_packages(exclude=('tests', 'docs', 'old')),
+    python_requires='>=3.8',
     install_requires=['pywinusb']
 )
@@ -1,8 +1,85 @@
 from .servo import Servo
 from .util import Util
+from concurrent.futures import ThreadPoolExecutor
+import numbers
+import queue
+import struct
+import threading
 import time
 
 
+_header = struct.Struct('<BBBB')
+_uint8_uint16 = struct.Struct('<BH')
+_pack_servo_position = _uint8_uint16.pack
+
+_WAIT_POLL_INTERVAL = 0.02  # seconds
+_WAIT_TOLERANCE = 4         # servo units, one degree
+_WAIT_MIN_POLL = 0.05       # seconds, one request/reply roundtrip with margin
+_USB_RECV_TIMEOUT = 50      # milliseconds
+_MAX_PENDING_WRITES = 2     # frames queued or being written
+
+
+def _checked_position(position):
+    if isinstance(position, numbers.Integral):
+        if position < 0 or position > 1000:
+            raise ValueError('Parameter \'position\' must be between 0 and 1000.')
+        return position
+    if isinstance(position, float):
+        if position < -125.0 or position > 125.0:
+            raise ValueError('Parameter \'position\' must be between -125.0 and 125.0.')
+        return Util._angle_to_position(position)
+    raise ValueError('Parameter \'position\' is not valid.')
+
+def _checked_duration(duration):
+    if not isinstance(duration, numbers.Integral) or duration < 0 or duration > 0xffff:
+        raise ValueError('Parameter \'duration\' must be an int value between 0 and 65535.')
+    return duration
+
+def _checked_servo_id(servo_id):
+    if not isinstance(servo_id, numbers.Integral) or servo_id < 0 or servo_id > 0xff:
+        raise ValueError('Servo ID must be an int value between 0 and 255.')
+    return servo_id
+
+def _pack_id(servo_id, position):
+    if position == None:
+        raise ValueError('Parameter \'position\' missing.')
+    return 1, _pack_servo_position(_checked_servo_id(servo_id), _checked_position(position))
+
+def _pack_servo(servo, position):
+    return 1, _pack_servo_position(_checked_servo_id(servo.servo_id), servo.position)
+
+def _pack_list_item(servo):
+    if isinstance(servo, Servo):
+        return _pack_servo_position(_checked_servo_id(servo.servo_id), servo.position)
+    if len(servo) == 2 and isinstance(servo[0], int):
+        return _pack_servo_position(_checked_servo_id(servo[0]), _checked_position(servo[1]))
+    raise ValueError('Parameter list \'servos\' is not valid.')
+
+def _pack_list(servos, position):
+    if len(servos) > 0xff:
+        raise ValueError('Parameter list \'servos\' must not hold more than 255 servos.')
+    return len(servos), b''.join([_pack_list_item(servo) for servo in servos])
+
+_position_packers = {
+    int: _pack_id,
+    float: _pack_id,
+    Servo: _pack_servo,
+    list: _pack_list
+}
+
+def _move_data(servos, position=None, duration=1000):
+    packer = _position_packers.get(type(servos))
+    if packer == None:
+        packer = next((_position_packers[t] for t in type(servos).__mro__ if t in _position_packers), None)
+        if packer == None:
+            raise ValueError('Parameter \'servos\' is not valid.')
+    count, positions = packer(servos, position)
+
+    data = bytearray(_uint8_uint16.pack(count, _checked_duration(duration)))
+    data += positions
+    return data
+
+
 class Controller:
     SIGNATURE               = 0x55
     CMD_SERVO_MOVE          = 0x03
@@ -11,9 +88,14 @@ class Controller:
     CMD_GET_SERVO_POSITION  = 0x15
 
     def __init__(self, com_port, debug=False):
-        if com_port.startswith('COM'):
+        if com_port.startswith('COM') or com_port.startswith('/dev/'):
             import serial
             self._device = serial.Serial(com_port, 9600, timeout = 1)
+            try:
+                # Only Linux supports this; Windows and other POSIX ports keep their defaults.
+                self._device.set_low_latency_mode(True)
+            except (AttributeError, NotImplementedError, ValueError):
+                pass
             self._is_serial = True
         elif com_port.startswith('USB'):
             import hid
@@ -32,47 +114,62 @@ class Controller:
             raise ValueError('com_port parameter incorrect.')
         self.debug = debug
         self._input_report = []
+        self._write = self._device.write
+        self._read = self._device.read
+        self._sig = self.SIGNATURE
+        # USB report ID, header and the largest payload the length byte allows.
+        self._tx_buf = bytearray(1 + 4 + 253)
+        self._tx_view = memoryview(self._tx_buf)
+        self._tx_offset = 0 if self._is_serial else 1  # USB leaves _tx_buf[0] as report ID 0.
+        self._tx_errors = queue.SimpleQueue()
+        self._tx_slots = threading.BoundedSemaphore(_MAX_PENDING_WRITES)
+        self._frame_battery = self._build_frame(self.CMD_GET_BATTERY_VOLTAGE)
+        self._frame_stop_all = self._build_frame(self.CMD_SERVO_STOP, bytes([6, 1,2,3,4,5,6]))
+        # All device I/O runs on this one worker, in submission order.
+        self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix='xarm-io')
 
     def setPosition(self, servos, position=None, duration=1000, wait=False):
-        data = bytearray([1, duration & 0xff, (duration & 0xff00) >> 8])
-
-        if isinstance(servos, int) or isinstance(servos, float):
-            if position == None:
-                raise ValueError('Parameter \'position\' missing.')
-            if isinstance(position, int):
-                if position < 0 or position > 1000:
-                    raise ValueError('Parameter \'position\' must be between 0 and 1000.')
-            if isinstance(position, float):
-                if position < -125.0 or position > 125.0:
-                    raise ValueError('Parameter \'position\' must be between -125.0 and 125.0.')
-                position = Util._angle_to_position(position)
-            data.extend([servos, position & 0xff, (position & 0xff00) >> 8])
-        elif isinstance(servos, Servo):
-            data.extend([servos.servo_id, servos.position & 0xff, (servos.position & 0xff00) >> 8])
-        elif isinstance(servos, list):
-            data[0] = len(servos)
-            for servo in servos:            
-                if isinstance(servo, Servo):
-                    data.extend([servo.servo_id, servo.position & 0xff, (servo.position & 0xff00) >> 8])
-                elif len(servo) == 2 and isinstance(servo[0], int):
-                    if isinstance(servo[1], int):
-                        if servo[1] < 0 or servo[1] > 1000:
-                            raise ValueError('Parameter \'position\' must be between 0 and 1000.')
-                        position = servo[1]
-                    elif isinstance(servo[1], float):
-                        if servo[1] < -125.0 or servo[1] > 125.0:
-                            raise ValueError('Parameter \'position\' must be between -125.0 and 125.0.')
-                        position = Util._angle_to_position(servo[1])
-                    data.extend([servo[0], position & 0xff, (position & 0xff00) >> 8])
-                else:
-                    raise ValueError('Parameter list \'servos\' is not valid.')
-        else:
-            raise ValueError('Parameter \'servos\' is not valid.')
+        data = _move_data(servos, position, duration)
 
         self._send(self.CMD_SERVO_MOVE, data)
 
         if wait:
-            time.sleep(duration/1000)
+            self._wait_for_move(data, duration)
+
+    def setPositionBatch(self, moves):
+        frames = [self._build_frame(self.CMD_SERVO_MOVE, _move_data(*move)) for move in moves]
+        if not frames:
+            return
+
+        if self._is_serial:
+            self._send_raw(b''.join(frames))
+        else:  # Is USB
+            # The protocol sends one command per HID report.
+            for frame in frames:
+                self._send_raw(frame)
+
+    def _wait_for_move(self, data, duration):
+        deadline = time.monotonic() + duration / 1000
+        targets = list(_uint8_uint16.iter_unpack(bytes(data[3:])))
+        request = bytearray([len(targets)])
+        request.extend(servo_id for servo_id, _ in targets)
+        length = 1 + len(targets) * 3
+
+        while True:
+            time.sleep(min(_WAIT_POLL_INTERVAL, max(0, deadline - time.monotonic())))
+            remaining = deadline - time.monotonic()
+            if remaining < _WAIT_MIN_POLL:
+                # Too little time left for a reply; a cut-off poll would leave it for the next read.
+                time.sleep(max(0, remaining))
+                return
+            self._discard_input()
+            self._send(self.CMD_GET_SERVO_POSITION, request)
+            reply = self._recv(self.CMD_GET_SERVO_POSITION, length, remaining)
+            if reply == None or len(reply) < length:
+                continue  # No answer this time, keep waiting.
+            positions = _uint8_uint16.iter_unpack(bytes(reply[1:length]))
+            if all(abs(position - target) <= _WAIT_TOLERANCE for (_, position), (_, target) in zip(positions, targets)):
+                return
 
     def getPosition(self, servos, degrees=False):
         if isinstance(servos, int):
@@ -86,16 +183,18 @@ class Controller:
         else:
             raise ValueError('Parameter \'servos\' is not valid.')
 
+        self._discard_input()
         self._send(self.CMD_GET_SERVO_POSITION, data)
 
-        data = self._recv(self.CMD_GET_SERVO_POSITION)
+        length = 1 + data[0] * 3
+        data = self._recv(self.CMD_GET_SERVO_POSITION, length)
 
-        if data != None:
+        if data != None and len(data) >= length:
             if isinstance(servos, list):
-                for i in range(data[0]):
-                    servos[i].position = data[i*3+3] * 256 + data[i*3+2]
+                for servo, (_, position) in zip(servos, _uint8_uint16.iter_unpack(data[1:length])):
+                    servo.position = position
             else:
-                position = data[3] * 256 + data[2]
+                position = _uint8_uint16.unpack_from(data, 1)[1]
                 return Util._position_to_angle(position) if degrees else position
         else:
             raise Exception('Function \'getPosition\' recv error.')
@@ -115,72 +214,136 @@ class Controller:
                 elif isinstance(servo, Servo):
                     data.append(servo.servo_id)
         elif servos == None:
-            data = [6, 1,2,3,4,5,6]
+            self._send_raw(self._frame_stop_all)
+            return
         else:
             raise ValueError('servos parameter incorrect.')
 
         self._send(self.CMD_SERVO_STOP, data)
 
     def getBatteryVoltage(self):
-        self._send(self.CMD_GET_BATTERY_VOLTAGE)
+        self._discard_input()
+        self._send_raw(self._frame_battery)
         
-        data = self._recv(self.CMD_GET_BATTERY_VOLTAGE)
+        data = self._recv(self.CMD_GET_BATTERY_VOLTAGE, 2)
         if data != None:
             return (data[1] * 256 + data[0]) / 1000.0
         else:
             return None
 
     def _send(self, cmd, data = []):
+        self._queue_write(self._write_frame, cmd, data)
+
+    def _send_raw(self, frame):
+        self._queue_write(self._write_raw, frame)
+
+    def _queue_write(self, write, *args):
+        self._raise_tx_error()
+        # Block while the link is behind so queued commands do not go stale.
+        self._tx_slots.acquire()
+        self._io.submit(write, *args).add_done_callback(self._tx_done)
+
+    def _discard_input(self):
+        self._io.submit(self._drain_input)
+
+    def _recv(self, cmd, length, timeout=None):
+        self._raise_tx_error()
+        data = self._io.submit(self._read_frame, cmd, length, timeout).result()
+        # The worker ran this call's own request write first, so its failure is reported here.
+        self._raise_tx_error()
+        return data
+
+    def _tx_done(self, future):
+        self._tx_slots.release()
+        if future.exception() != None:
+            self._tx_errors.put(future.exception())
+
+    def _raise_tx_error(self):
+        try:
+            error = self._tx_errors.get_nowait()
+        except queue.Empty:
+            return
+        raise error
+
+    def _build_frame(self, cmd, data = b''):
+        frame = bytes([self.SIGNATURE, self.SIGNATURE, len(data) + 2, cmd]) + data
+        return frame if self._is_serial else b'\x00' + frame  # USB reports lead with report ID 0.
+
+    def _write_raw(self, frame):
         if self.debug:
-            print('Send Data (' + str(len(data)) + '): ' + ' '.join('{:02x}'.format(x) for x in data))
+            print('Send Frame: ' + frame.hex(' '))
+        self._write(frame)
+
+    def _write_frame(self, cmd, data):
+        sig = self._sig
+        length = len(data)
+
+        if self.debug:
+            print('Send Data (' + str(length) + '): ' + bytes(data).hex(' '))
+
+        buf = self._tx_buf
+        i = self._tx_offset
+        buf[i] = sig
+        buf[i + 1] = sig
+        buf[i + 2] = length + 2
+        buf[i + 3] = cmd
+        buf[i + 4:i + 4 + length] = data
 
         if self._is_serial:
-            self._device.flush()
-            self._device.write([self.SIGNATURE, self.SIGNATURE, len(data) + 2, cmd])
-            if len(data) > 0:
-                self._device.write(data)
+            self._write(self._tx_view[:4 + length])
         else:  # Is USB
-            report_data = [
-                0, 
-                self.SIGNATURE, 
-                self.SIGNATURE, 
-                len(data) + 2,
-                cmd
-            ]
-            if len(data):
-                report_data.extend(data)
             self._usb_recv_event = False
-            self._device.write(report_data)
+            self._write(bytes(self._tx_view[:5 + length]))
 
-    def _recv(self, cmd):
+    def _drain_input(self):
+        # Drop replies that arrived after an earlier read gave up on them.
         if self._is_serial:
-            data = self._device.read(4)
+            self._device.reset_input_buffer()
+        else:  # Is USB, opened non-blocking so an empty read returns at once.
+            while self._read(64):
+                pass
 
-            if self.debug:
-                print('Recv Data: ' + ' '.join('{:02x}'.format(x) for x in data), end=" ")
+    def _read_serial(self, n, timeout):
+        port_timeout = self._device.timeout
+        if timeout == None or timeout >= port_timeout:
+            return self._read(n)
+        self._device.timeout = timeout
+        try:
+            return self._read(n)
+        finally:
+            self._device.timeout = port_timeout
 
-            if data[0] == self.SIGNATURE and data[1] == self.SIGNATURE and data[3] == cmd:
-                length = data[2]
-                data = self._device.read(length)
+    def _read_frame(self, cmd, length, timeout=None):
+        if self._is_serial:
+            data = self._read_serial(4 + length, timeout)
+            if len(data) >= 4 and data[0] == self._sig and data[1] == self._sig and data[2] - 2 > length:
+                # Read the rest of a longer reply so the next frame starts aligned.
+                data += self._read_serial(data[2] - 2 - length, timeout)
 
-                if self.debug:
-                    print(' '.join('{:02x}'.format(x) for x in data))
-            
-                return data
-            else:
-                return None
+            if self.debug:
+                print('Recv Data: ' + data.hex(' '))
         else:  # Is USB
-            self._input_report = self._device.read(64, 50)
-            if self._input_report[0] == self.SIGNATURE and self._input_report[1] == self.SIGNATURE and self._input_report[3] == cmd:
-                length = self._input_report[2]
-                data = self._input_report[4:4 + length]
-                if self.debug:
-                    print('Recv Data: ' + ' '.join('{:02x}'.format(x) for x in data))
-                return data
+            usb_timeout = _USB_RECV_TIMEOUT
+            if timeout != None:
+                usb_timeout = max(1, min(usb_timeout, int(timeout * 1000)))
+            self._input_report = self._read(64, usb_timeout)
+            data = bytes(self._input_report)
+
+        if len(data) < 4:
+            return None
+        sig0, sig1, frame_length, rcmd = _header.unpack_from(data)
+        if (sig0, sig1, rcmd) != (self._sig, self._sig, cmd):
+            return None
+
+        data = memoryview(data)[4:2 + frame_length]
+        if self.debug and not self._is_serial:
+            print('Recv Data: ' + data.hex(' '))
+        if len(data) < length:
             return None
+        return data
 
     def usb_event_handler(self, data, event_type):
         self._input_report = data
         self._usb_recv_event = True
         if self.debug:
-            print('USB Recv Data: ' + ' '.join('{:02x}'.format(x) for x in data))
\ No newline at end of file
+            print('USB Recv Data: ' + bytes(data).hex(' '))
\ No newline at end of file
@@ -1,3 +1,6 @@
+import functools
+
+
 class Util:
     @staticmethod
     def _lerp(i, j, k):
@@ -12,6 +15,7 @@ class Util:
         return float(round(x*4) / 4)
 
     @staticmethod
+    @functools.lru_cache(maxsize=4096, typed=True)
     def _angle_to_position(degrees):
         if not isinstance(degrees, float) or degrees < -125.0 or degrees > 125.0:
             raise ValueError('Parameter \'degrees\' must be a float value between -125.0 and 125.0')